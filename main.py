@@ -1,16 +1,91 @@
+import asyncio
+import base64
+import hashlib
+import json
 import logging
-from os import access
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
 
 from fastmcp import FastMCP, Context
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 
 
 logger = logging.getLogger(__name__)
 
 mcp = FastMCP("mcp-linkedin", port=3333, host='0.0.0.0')
 
+# Versioned API release (YYYYMM) sent with every call; LinkedIn sunsets old versions, so allow an override
+LINKEDIN_API_VERSION = os.getenv("LINKEDIN_API_VERSION", "202609")
+
+# Shared session for the OAuth token endpoint so refreshes reuse the pooled TLS connection.
+# Refreshing is safe to repeat, so transient server errors are retried with a short backoff.
+# 429 is not retried: without honouring Retry-After a quick retry only burns more rate-limit quota,
+# and honouring it (uncapped in urllib3) would stall the caller while it holds the refresh lock.
+_OAUTH_SESSION = requests.Session()
+_OAUTH_SESSION.headers.update({"Content-Type": "application/x-www-form-urlencoded"})
+_OAUTH_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=16,
+        max_retries=Retry(
+            total=3,
+            backoff_factor=0.3,
+            status_forcelist=[500, 502, 503, 504],
+            allowed_methods=frozenset({"POST"}),
+            respect_retry_after_header=False,
+            raise_on_status=False,
+        ),
+    ),
+)
+# (connect, read) timeout in seconds for token requests
+_OAUTH_TIMEOUT = (3.05, 10)
+
+# (client_id, client_secret digest, user token) -> (shared client, time cached), in least-recently-used order.
+# Only clients whose credentials just worked are cached, so their session and token outlive a single tool call.
+_CLIENT_CACHE: "OrderedDict[Tuple[str, str, str], Tuple[LinkedInOAuthClient, float]]" = OrderedDict()
+_CLIENT_CACHE_LOCK = threading.Lock()
+# Upper bound on cached clients; the least recently used are evicted and their sessions closed
+_CLIENT_CACHE_MAX = 256
+# Absolute lifetime, counted from when it was cached, of a client whose token expiry is unknown
+# (callers supplying an access token directly); hits do not extend it
+_CLIENT_TTL = 3600
+# Per-credential refresh locks with a count of callers using each; an entry is dropped once nobody
+# holds or waits on it, so only credentials with a refresh in flight keep a lock
+_REFRESH_LOCKS: Dict[Tuple[str, str, str], List[Any]] = {}
+_LOCKS_META = threading.Lock()
+# Seconds shaved off expires_in so a cached token is never used right at its expiry
+_TOKEN_EXPIRY_MARGIN = 60
+
+# Constant part of the /v2/posts payload; treated as read-only and shared by every post
+_POST_TEMPLATE = {
+    "distribution": {
+        "feedDistribution": "MAIN_FEED",
+        "targetEntities": [],
+        "thirdPartyDistributionChannels": [],
+    },
+    "lifecycleState": "PUBLISHED",
+    "isReshareDisabledByAuthor": True,
+}
+
+
+def _get_id_token_sub(id_token: str) -> Optional[str]:
+    """Read the ``sub`` claim from an OpenID id_token without a network call."""
+    try:
+        payload = id_token.split(".")[1]
+        # JWT segments are base64url without padding
+        claims = json.loads(base64.urlsafe_b64decode(payload + "=" * (-len(payload) % 4)))
+        return claims.get("sub")
+    except (IndexError, ValueError, AttributeError) as e:
+        logger.warning(f"Could not decode id_token: {e}")
+        return None
+
 
 class LinkedInOAuthClient:
     """
@@ -22,12 +97,28 @@ class LinkedInOAuthClient:
         self.refresh_token = refresh_token or os.getenv("LINKEDIN_REFRESH_TOKEN")
         self.client_id = client_id or os.getenv("LINKEDIN_CLIENT_ID")
         self.client_secret = client_secret or os.getenv("LINKEDIN_CLIENT_SECRET")
+        # Lifetime in seconds reported by the last successful refresh
+        self.expires_in: Optional[int] = None
+        # Monotonic deadline after which the token is refreshed before use instead of waiting for a 401
+        self.expires_at: Optional[float] = None
+        # Member id taken from the OpenID id_token, when LinkedIn includes one in the token response
+        self.sub: Optional[str] = None
+        # "urn:li:person:<sub>" once resolved; lives as long as this client stays cached
+        self.author_urn: Optional[str] = None
         # Updated to use the REST endpoint for versioned APIs
         self.base_url = "https://api.linkedin.com"
 
+        # Serializes token refreshes of this client across worker threads; the generation is bumped on
+        # every attempt so callers that waited can reuse its outcome instead of refreshing again
+        self._refresh_lock = threading.Lock()
+        self._token_generation = 0
+        self._last_refresh_ok = False
+
         # Session for connection pooling and consistency
         self.session = requests.Session()
         self._setup_session()
+        if self.access_token:
+            self._apply_auth()
 
     def _setup_session(self):
         """Setup default headers and session configuration."""
@@ -37,17 +128,23 @@ class LinkedInOAuthClient:
                 "Accept": "application/json",
                 "Content-Type": "text/plain",
                 "X-Restli-Protocol-Version": "2.0.0",
-                "LinkedIn-Version": "X-Restli-Protocol-Version",  # Latest version as of July 2025
+                "LinkedIn-Version": LINKEDIN_API_VERSION,
             }
         )
 
-    def _get_auth_headers(self) -> Dict[str, str]:
-        """Get authorization headers with current access token."""
+    def _apply_auth(self):
+        """Set the bearer token on the session so requests merges it into every call."""
+        self.session.headers["Authorization"] = f"Bearer {self.access_token}"
+
+    def is_token_fresh(self) -> bool:
+        """Return True if the access token is known to be valid for longer than the safety margin."""
+        return bool(self.expires_at) and time.monotonic() < self.expires_at
+
+    def _ensure_authenticated(self):
+        """Raise if no access token has been applied to the session yet."""
         if not self.access_token:
             raise ValueError("No access token available. Please authenticate first.")
 
-        return {"Authorization": f"Bearer {self.access_token}"}
-
     def refresh_access_token(self) -> bool:
         """
         Refresh the access token using the refresh token.
@@ -67,15 +164,17 @@ class LinkedInOAuthClient:
         }
 
         try:
-            response = requests.post(
-                token_url,
-                data=data,
-                headers={"Content-Type": "application/x-www-form-urlencoded"},
-            )
+            response = _OAUTH_SESSION.post(token_url, data=data, timeout=_OAUTH_TIMEOUT)
 
             if response.status_code == 200:
                 token_data = response.json()
                 self.access_token = token_data.get("access_token")
+                self.expires_in = token_data.get("expires_in")
+                if self.expires_in:
+                    self.expires_at = time.monotonic() + self.expires_in - _TOKEN_EXPIRY_MARGIN
+                self._apply_auth()
+                if "id_token" in token_data:
+                    self.sub = _get_id_token_sub(token_data["id_token"]) or self.sub
                 # Update refresh token if provided
                 if "refresh_token" in token_data:
                     self.refresh_token = token_data["refresh_token"]
@@ -92,33 +191,46 @@ class LinkedInOAuthClient:
             logger.error(f"Error refreshing token: {e}")
             return False
 
+    def _refresh_if_current(self, generation: int) -> bool:
+        """
+        Refresh the access token unless another thread already did since ``generation`` was read.
+        Returns True if a fresh token is in place, False if the refresh failed.
+        """
+        with self._refresh_lock:
+            if self._token_generation == generation:
+                self._last_refresh_ok = self.refresh_access_token()
+                self._token_generation += 1
+            return self._last_refresh_ok
+
     def make_request(self, method: str, endpoint: str, **kwargs) -> requests.Response:
         """
         Make an authenticated request to LinkedIn API.
         Automatically handles token refresh if needed.
         """
-        url = f"{self.base_url}{endpoint}"
-        headers = {**self.session.headers, **self._get_auth_headers()}
+        if self.expires_at and time.monotonic() >= self.expires_at and self.refresh_token:
+            logger.info("Access token about to expire, refreshing before request...")
+            if not self._refresh_if_current(self._token_generation):
+                raise Exception("Failed to refresh access token")
 
-        if "headers" in kwargs:
-            headers.update(kwargs["headers"])
+        self._ensure_authenticated()
+        url = f"{self.base_url}{endpoint}"
 
-        kwargs["headers"] = headers
+        # Encode a JSON body once so a 401 retry resends the same bytes instead of re-serializing
+        if kwargs.get("json") is not None:
+            kwargs["data"] = json.dumps(kwargs.pop("json"), separators=(",", ":"), allow_nan=False).encode("utf-8")
+            kwargs["headers"] = {"Content-Type": "application/json", **(kwargs.get("headers") or {})}
 
         try:
+            generation = self._token_generation
             response = self.session.request(method, url, **kwargs)
 
-            print(response.text)
+            logger.debug("LinkedIn %s %s -> %d", method, endpoint, response.status_code)
 
             # If unauthorized, try to refresh token once
             if response.status_code == 401:
                 logger.info("Access token expired, attempting refresh...")
-                if self.refresh_access_token():
+                if self._refresh_if_current(generation):
                     # Retry with new token
-                    headers = {**self.session.headers, **self._get_auth_headers()}
-                    if "headers" in kwargs:
-                        headers.update(kwargs["headers"])
-                    kwargs["headers"] = headers
                     response = self.session.request(method, url, **kwargs)
                 else:
                     raise Exception("Failed to refresh access token")
@@ -136,12 +248,13 @@ class LinkedInOAuthClient:
         if fields:
             endpoint += f"?fields={fields}"
 
+        self._ensure_authenticated()
+
         try:
             # For profile endpoint, we need to use the v2 base URL
             v2_url = f"https://api.linkedin.com{endpoint}"
-            headers = {**self.session.headers, **self._get_auth_headers()}
 
-            response = self.session.request("GET", v2_url, headers=headers)
+            response = self.session.request("GET", v2_url)
             response.raise_for_status()
             return response.json()
         except requests.exceptions.HTTPError as e:
@@ -159,7 +272,23 @@ class LinkedInOAuthClient:
                 )
 
 
+# Request headers carrying per-user LinkedIn credentials
+_CREDENTIAL_HEADERS = frozenset(
+    (b"linkedin_client_id", b"linkedin_client_secret", b"linkedin_access_token", b"linkedin_refresh_token")
+)
+
 
+def _get_credential_headers(ctx: Context) -> Dict[str, str]:
+    """Extract the LinkedIn credential headers from the incoming MCP request."""
+    if not (ctx and hasattr(ctx, 'request_context') and ctx.request_context):
+        return {}
+
+    headers_raw = ctx.request_context.request.get("headers", {})
+
+    # ASGI headers are (bytes, bytes) pairs; decode only the few we actually read
+    if isinstance(headers_raw, list):
+        return {key.decode(): value.decode() for key, value in headers_raw if key in _CREDENTIAL_HEADERS}
+    return headers_raw
 
 
 # Regular functions for testing and direct usage
@@ -171,17 +300,7 @@ def _get_profile_info(ctx: Context) -> str:
         String containing formatted profile information or error message
     """
     try:
-        headers = {}
-        if ctx and hasattr(ctx, 'request_context') and ctx.request_context:
-            headers_raw = ctx.request_context.request.get("headers", {})
-
-            # Convert headers from list of tuples to dictionary
-            if isinstance(headers_raw, list):
-                headers = {key.decode() if isinstance(key, bytes) else key:
-                               value.decode() if isinstance(value, bytes) else value
-                           for key, value in headers_raw}
-            else:
-                headers = headers_raw
+        headers = _get_credential_headers(ctx)
 
         client_id = headers.get("linkedin_client_id")
         client_secret = headers.get("linkedin_client_secret")
@@ -192,39 +311,148 @@ def _get_profile_info(ctx: Context) -> str:
         else:
             return f"Error creating post: Miss client_id or client_secret or access_token"
 
-        client = LinkedInOAuthClient(client_id=client_id, client_secret=client_secret, access_token=access_token)
+        key = _client_cache_key(client_id, client_secret, access_token)
+        client = _get_cached_client(key)
 
-        profile = client.get_profile()
+        if client:
+            profile = client.get_profile()
+        else:
+            client = LinkedInOAuthClient(client_id=client_id, client_secret=client_secret, access_token=access_token)
+            try:
+                profile = client.get_profile()
+            except Exception:
+                client.session.close()
+                raise
+            # Only keep clients whose token LinkedIn actually accepted
+            _cache_client(key, client)
 
-        result = "LinkedIn Profile Information:\n"
-        for key, value in profile.items():
-            result += f"{key}: {value}\n"
+        lines = ["LinkedIn Profile Information:"]
+        lines.extend(f"{key}: {value}" for key, value in profile.items())
 
-        return result
+        return "\n".join(lines) + "\n"
 
     except Exception as e:
         logger.error(f"Error retrieving profile: {e}")
         return f"Error retrieving profile: {str(e)}"
 
 
-# def _refresh_token() -> str:
-#     """
-#     Manually refresh the LinkedIn access token using the refresh token.
-#
-#     Returns:
-#         String indicating success or failure of token refresh
-#     """
-#     try:
-#         success = client.refresh_access_token()
-#
-#         if success:
-#             return "Access token refreshed successfully."
-#         else:
-#             return "Failed to refresh access token. Check your refresh token and client credentials."
-#
-#     except Exception as e:
-#         logger.error(f"Error refreshing token: {e}")
-#         return f"Error refreshing token: {str(e)}"
+def _client_cache_key(client_id: str, client_secret: str, token: str) -> Tuple[str, str, str]:
+    """
+    Build the client cache key for a set of credentials.
+
+    Clients are keyed by the user's token rather than just the app credentials,
+    since one LinkedIn app is shared by every member posting through it. The
+    secret is part of the key too, so a caller with the wrong secret never
+    reuses a token that was obtained with the right one.
+    """
+    return (client_id, hashlib.sha256(client_secret.encode()).hexdigest(), token)
+
+
+def _get_cached_client(key: Tuple[str, str, str]) -> Optional[LinkedInOAuthClient]:
+    """
+    Return the cached client for ``key``, marking it most recently used.
+
+    A client whose access token has gone stale is still returned, so the caller can refresh
+    it in place and keep its warm session and resolved author.
+    """
+    with _CLIENT_CACHE_LOCK:
+        entry = _CLIENT_CACHE.get(key)
+        if entry is None:
+            return None
+
+        client, cached_at = entry
+        # Clients given an access token directly have no known expiry, so they get a fixed lifetime
+        if not client.expires_at and time.monotonic() >= cached_at + _CLIENT_TTL:
+            del _CLIENT_CACHE[key]
+            client.session.close()
+            return None
+
+        _CLIENT_CACHE.move_to_end(key)
+        return client
+
+
+def _evict_client(key: Tuple[str, str, str], client: LinkedInOAuthClient):
+    """Drop ``client`` from the cache if it is still the entry for ``key``, and close its session."""
+    with _CLIENT_CACHE_LOCK:
+        entry = _CLIENT_CACHE.get(key)
+        if entry and entry[0] is client:
+            del _CLIENT_CACHE[key]
+    client.session.close()
+
+
+def _cache_client(key: Tuple[str, str, str], client: LinkedInOAuthClient):
+    """Cache a client whose credentials were just accepted, evicting the least recently used beyond the cap."""
+    with _CLIENT_CACHE_LOCK:
+        previous = _CLIENT_CACHE.pop(key, None)
+        if previous and previous[0] is not client:
+            previous[0].session.close()
+
+        _CLIENT_CACHE[key] = (client, time.monotonic())
+
+        while len(_CLIENT_CACHE) > _CLIENT_CACHE_MAX:
+            _, (evicted, _) = _CLIENT_CACHE.popitem(last=False)
+            evicted.session.close()
+
+
+@contextmanager
+def _refresh_lock(key: Tuple[str, str, str]):
+    """Hold the refresh lock for one credential, so a slow refresh only blocks callers with the same key."""
+    with _LOCKS_META:
+        entry = _REFRESH_LOCKS.setdefault(key, [threading.Lock(), 0])
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with _LOCKS_META:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del _REFRESH_LOCKS[key]
+
+
+def _get_authorized_client(client_id: str, client_secret: str, refresh_token: str) -> LinkedInOAuthClient:
+    """
+    Return the shared client for these credentials holding a valid access token.
+
+    The client keeps its token until shortly before it expires, so repeated posts skip the token refresh.
+    """
+    key = _client_cache_key(client_id, client_secret, refresh_token)
+
+    client = _get_cached_client(key)
+    if client and client.is_token_fresh():
+        return client
+
+    with _refresh_lock(key):
+        client = _get_cached_client(key)
+        if client:
+            # Another caller may have refreshed while we waited for the lock
+            if client.is_token_fresh():
+                return client
+
+            # Refresh the cached client in place, keeping its session and author
+            if client._refresh_if_current(client._token_generation):
+                return client
+
+            _evict_client(key, client)
+            raise Exception("Failed to refresh access token. Check your refresh token and client credentials.")
+
+        client = LinkedInOAuthClient(client_id=client_id, client_secret=client_secret, refresh_token=refresh_token)
+        if not client.refresh_access_token():
+            client.session.close()
+            raise Exception("Failed to refresh access token. Check your refresh token and client credentials.")
+
+        _cache_client(key, client)
+
+    return client
+
+
+def _get_author_urn(client: LinkedInOAuthClient) -> str:
+    """Return the member URN for the client's credentials, looking it up via userinfo only once."""
+    if client.author_urn is None:
+        # The id_token from the refresh already names the member; fall back to userinfo otherwise
+        sub = client.sub or client.get_profile()["sub"]
+        client.author_urn = "urn:li:person:" + sub
+    return client.author_urn
 
 
 def _create_post(
@@ -244,18 +472,9 @@ def _create_post(
     Returns:
         String containing the post creation result or error message
     """
+    client = None
     try:
-        headers = {}
-        if ctx and hasattr(ctx, 'request_context') and ctx.request_context:
-            headers_raw = ctx.request_context.request.get("headers", {})
-
-            # Convert headers from list of tuples to dictionary
-            if isinstance(headers_raw, list):
-                headers = {key.decode() if isinstance(key, bytes) else key:
-                               value.decode() if isinstance(value, bytes) else value
-                           for key, value in headers_raw}
-            else:
-                headers = headers_raw
+        headers = _get_credential_headers(ctx)
 
         client_id = headers.get("linkedin_client_id")
         client_secret = headers.get("linkedin_client_secret")
@@ -269,31 +488,25 @@ def _create_post(
 
 
 
-        client = LinkedInOAuthClient(client_id=client_id, client_secret=client_secret, refresh_token=refresh_token)
-
-        client.refresh_access_token()
-
-        profile = client.get_profile()
+        client = _get_authorized_client(client_id, client_secret, refresh_token)
 
-        author_id = profile.get("sub")
-
-        author = "urn:li:person:" + author_id
+        author = _get_author_urn(client)
 
         # Create the post payload according to LinkedIn REST API spec
         post_data = {
+            **_POST_TEMPLATE,
             "author": author,
             "commentary": commentary,
             "visibility": visibility,
-            "distribution": {
+        }
+        if feed_distribution != "MAIN_FEED":
+            post_data["distribution"] = {
                 "feedDistribution": feed_distribution,
                 "targetEntities": [],
                 "thirdPartyDistributionChannels": [],
-            },
-            "lifecycleState": "PUBLISHED",
-            "isReshareDisabledByAuthor": True,
-        }
+            }
 
-        print(post_data)
+        logger.debug("Post payload: %s", post_data)
 
         # Make the API call to create the post using the REST API
         response = client.make_request(
@@ -313,7 +526,11 @@ def _create_post(
             try:
                 error_details = e.response.text
                 logger.error(f"API Error Response: {error_details}")
-                
+
+                # The cached author may belong to credentials that are no longer valid
+                if e.response.status_code in (401, 403) and client:
+                    client.author_urn = None
+
                 if e.response.status_code == 403:
                     return f"Error creating post: Permission denied (403).\n" \
                            f"This usually means your LinkedIn app doesn't have the required permissions.\n" \
@@ -322,25 +539,26 @@ def _create_post(
                            f"API Response: {error_details}"
                 else:
                     return f"Error creating post: {str(e)}\nAPI Response: {error_details}"
-            except:
+            except (AttributeError, UnicodeDecodeError):
                 pass
         return f"Error creating post: {str(e)}"
 
 
-# MCP Tool decorators that call the internal functions
+# MCP Tool decorators that call the internal functions.
+# The blocking LinkedIn calls run in a worker thread so concurrent tool calls don't stall the event loop.
 @mcp.tool
-def get_profile_info(ctx: Context) -> str:
+async def get_profile_info(ctx: Context) -> str:
     """
     Get the authenticated user's LinkedIn profile information.
 
     Returns:
         String containing formatted profile information or error message
     """
-    return _get_profile_info(ctx)
+    return await asyncio.to_thread(_get_profile_info, ctx)
 
 
 @mcp.tool
-def create_post(
+async def create_post(
     ctx: Context,
     commentary: str,
     visibility: str = "PUBLIC",
@@ -357,7 +575,7 @@ def create_post(
     Returns:
         String containing the post creation result or error message
     """
-    return _create_post(ctx, commentary, visibility, feed_distribution)
+    return await asyncio.to_thread(_create_post, ctx, commentary, visibility, feed_distribution)
 
 
 if __name__ == "__main__":